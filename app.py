@@ -1,24 +1,35 @@
-import json
+import gzip
+import hashlib
+import mmap
 import os
-import sqlite3
 import sys
 import threading
 import time
+from functools import wraps
 
+import brotli
+import orjson
 from decouple import config
-from flask import Blueprint, Flask, Response, abort, jsonify, request, url_for
-from flask_caching import Cache
+from flask import Flask, Response, jsonify, request, url_for
+from flask_compress import Compress
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from flask_restplus import Api, Resource, fields
+from flask_restx import Api, Resource
+
+try:
+    from gevent import get_hub
+    from gevent.monkey import is_module_patched
+except ImportError: # only installed for the gevent workers
+    get_hub = None
 
 import src.utils as util
-from src.errors import RegionNotFound, CountryNotFound
+from src.errors import CountryNotFound, DataTypeNotFound, RegionNotFound
 
 # from flask_restful import Api, Resource
 
 API_VERSION = "v1"
 BASE_PATH = config("BASE_PATH")
+REDIS_URL = config("REDIS_URL", default="redis://localhost:6379/0")
 ROUTES = [
     f"{BASE_PATH}/doc/",
     f"{BASE_PATH}/api/{API_VERSION}/all/",
@@ -50,19 +61,22 @@ responses = {
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
+app.config["RESTX_ERROR_404_HELP"] = False
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 1024
+app.config["COMPRESS_LEVEL"] = 4
+app.config["COMPRESS_STREAMS"] = False # the mapped bodies are streamed and precompressed
+Compress(app)
 limiter = Limiter(
     app,
     get_remote_address,
+    storage_uri=REDIS_URL, # counters shared by every worker
+    storage_options={"max_connections": 10, "socket_timeout": 0.2},
+    strategy="fixed-window", # one INCR + EXPIRE round trip per request
+    in_memory_fallback_enabled=True, # per worker limits while redis is unreachable
     default_limits=["3/second", "60/minute", "2000/hour"],
     default_limits_exempt_when=util.no_limit_owner
 )
-cache = Cache(
-    app,
-    config={
-        "CACHE_TYPE": "simple",
-        "CACHE_DEFAULT_TIMEOUT": 15 * 60 # 30 minutes caching
-    }
-)
 class SSLApiDoc(Api):
     @property
     def specs_url(self):
@@ -73,115 +87,236 @@ class SSLApiDoc(Api):
 api = SSLApiDoc(app, doc='/doc/', version='1.0', title='COVID19 API',
         description="Coronavirus COVID 19 API")
 
+DATA_TYPES = ("confirmed", "recovered", "deaths")
+DATA_FILES = (
+    ["data.json"]
+    + [f"csv_{data_type}.json" for data_type in DATA_TYPES]
+    + [f"csv_{data_type}_region.json" for data_type in DATA_TYPES]
+    + [f"csv_{data_type}_us_region.json" for data_type in ("confirmed", "deaths")]
+)
+RELOAD_INTERVAL = config("RELOAD_INTERVAL", default=30, cast=int)
+_US_ALIASES = frozenset(("us", "united states", "usa"))
+CACHE_MAX_AGE = 15 * 60
+PRECOMPRESS_MIN_SIZE = 64 * 1024
+
+# file name -> loaded entry, entries are replaced as a whole so readers never need a lock.
+# Everything derived from a file is built here by the import or the watcher thread alone,
+# concurrent requests only read it and never compute the same aggregate twice.
+_STATE = {}
+# file name -> mtime of the version that failed to load, retried once the file changes
+_FAILED = {}
+
+def _etag(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+def _precompress(body):
+    """Encode `body` with brotli and gzip"""
+    # no timestamp in the gzip header so every worker and reload serves the same bytes per ETag
+    return {"br": brotli.compress(body, quality=5), "gzip": gzip.compress(body, compresslevel=4, mtime=0)}
+
+def _prepare(body):
+    """Return the cacheable_response arguments of `body`"""
+    encoded = _precompress(body) if len(body) >= PRECOMPRESS_MIN_SIZE else None
+    return body, _etag(body), encoded
+
+def _lookup_key(name):
+    """Return the interned lowercase lookup key of `name`"""
+    return sys.intern(name.lower())
+
+def _country_index(entries):
+    """Index values by country name, iso2 and iso3"""
+    index = {}
+    for country, iso2, iso3, value in entries:
+        for key in (country, iso2, iso3):
+            if key:
+                index.setdefault(_lookup_key(key), value)
+    return index
+
+def _build_country_bytes(data):
+    return _country_index(
+        (region["country"], region["iso2"], region["iso3"], _prepare(orjson.dumps(region)))
+        for region in data)
+
+def _build_history_bytes(data):
+    return _country_index(
+        (country, value["iso2"], value["iso3"], _prepare(orjson.dumps(value)))
+        for country, value in data.items())
+
+def _build_region_bytes(data):
+    countries = []
+    for country, value in data.items():
+        regions = {}
+        for region, history in value["regions"].items():
+            regions.setdefault(_lookup_key(region), _prepare(orjson.dumps(history)))
+        countries.append((country, value["iso2"], value["iso3"], regions))
+    return _country_index(countries)
+
+def _build_regions_bytes(data):
+    return _country_index(
+        (country, value["iso2"], value["iso3"], _prepare(orjson.dumps(value["regions"])))
+        for country, value in data.items())
+
+def _build_world_bytes(data):
+    # runs once per reload of the file, never on a request, csv_to_json already stores the
+    # daily values as int
+    world = {}
+    for country in data.values():
+        for day, value in country["history"].items():
+            world[day] = world.get(day, 0) + value
+    return orjson.dumps({"history": world})
+
+def _load(name, mtime):
+    """Read `name` and precompute the bodies served from it"""
+    # mapped read-only so the workers share the file pages through the page cache, the
+    # mapping is released with the entry, util.write_json replaces the files instead of
+    # truncating them under it
+    with open(name, "rb") as f:
+        body = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data = orjson.loads(memoryview(body))
+    # streamed, and with COMPRESS_STREAMS off Compress leaves it alone, so it is always precompressed
+    entry = {"mtime": mtime, "file": (body, _etag(body), _precompress(body))}
+    if name == "data.json":
+        entry["countries"] = _build_country_bytes(data)
+    elif name.endswith("_region.json"):
+        # unlike the mapped file, these bodies live on the heap of every worker, the
+        # region file is held there about twice, once by region and once by country
+        entry["regions_by_name"] = _build_region_bytes(data)
+        entry["regions"] = _build_regions_bytes(data)
+    else:
+        entry["countries"] = _build_history_bytes(data)
+        entry["world"] = _prepare(_build_world_bytes(data))
+    return entry
+
+def _load_off_loop(name, mtime):
+    """Run `_load` in an OS thread under gevent workers"""
+    if get_hub is not None and is_module_patched("threading"):
+        return get_hub().threadpool.apply(_load, (name, mtime))
+    return _load(name, mtime)
+
+def _reload_all():
+    """Reload the data files whose mtime changed"""
+    for name in DATA_FILES:
+        mtime = None
+        try:
+            mtime = os.stat(name).st_mtime
+            entry = _STATE.get(name)
+            if (entry is None or entry["mtime"] != mtime) and _FAILED.get(name) != mtime:
+                _STATE[name] = _load_off_loop(name, mtime)
+                _FAILED.pop(name, None)
+        except Exception:
+            if name not in _FAILED or _FAILED[name] != mtime: # a missing file fails with no mtime
+                app.logger.exception(f"Could not load {name}")
+            _FAILED[name] = mtime
+
+def _watcher():
+    while True:
+        time.sleep(RELOAD_INTERVAL)
+        _reload_all()
+
+_reload_all()
+threading.Thread(target=_watcher, daemon=True).start()
+
+
+def _chunks(body, size=1 << 16):
+    """Stream a mapped file body in slices"""
+    return (body[i:i + size] for i in range(0, len(body), size))
+
+def cacheable_response(body, etag=None, encoded=None):
+    """Build a JSON response validated by its ETag"""
+    if etag is None:
+        etag = _etag(body)
+    encoding = encoded and request.accept_encodings.best_match(list(encoded))
+    if encoding:
+        body, etag = encoded[encoding], f"{etag}:{encoding}"
+        tags = (etag,)
+    else:
+        tags = (etag, f"{etag}:br", f"{etag}:gzip")
+    for tag in tags:
+        if request.if_none_match.contains(tag):
+            response = Response(status=304)
+            response.set_etag(tag)
+            break
+    else:
+        response = Response(body if isinstance(body, bytes) else _chunks(body), mimetype="application/json")
+        response.content_length = len(body)
+        response.set_etag(etag)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    return response
+
+def json_response(func):
+    """Wrap the prepared body returned by `func` in a response"""
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        return cacheable_response(*func(*args, **kwargs))
+    return decorated_function
+
+@api.errorhandler(CountryNotFound)
+@api.errorhandler(DataTypeNotFound)
+@api.errorhandler(RegionNotFound)
+def not_found_error(e):
+    return {"message": f"{type(e).__name__} : {e}"}, 404
+
+@api.errorhandler
+def default_error(e):
+    # logged by the api, the details stay out of the response
+    return {"message": "Internal server error"}, 500
+
+def _entry(data_type, suffix=""):
+    """Return the loaded `data_type` file ending with `suffix`"""
+    if data_type not in DATA_TYPES:
+        raise DataTypeNotFound("This data type cannot be found. Please try again.")
+    name = f"csv_{data_type}{suffix}.json"
+    if name not in DATA_FILES: # no recovered file for the US states
+        raise DataTypeNotFound("This data type cannot be found. Please try again.")
+    return _STATE[name]
 
-@cache.memoize()
 def all_data():
-    try:
-        data = util.read_json("data.json")
-        return jsonify(data)
-    except Exception as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}")
+    return cacheable_response(*_STATE["data.json"]["file"])
 
-@cache.memoize()
+@json_response
 def all_country(country):
-    try:
-        data = util.read_json("data.json")
-        for region in data:
-            if util.pattern_match(
-                country,
-                region["country"],
-                region["iso2"],
-                region["iso3"]):
-                return jsonify(region)
+    body = _STATE["data.json"]["countries"].get(country.lower())
+    if body is None:
         raise CountryNotFound("This region cannot be found. Please try again.")
-    except CountryNotFound as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}", status=404)
-    except Exception as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}")
+    return body
 
-@cache.memoize()
 def history(data_type):
-    try:
-        data = util.read_json(f"csv_{data_type}.json")
-        return jsonify(data)
-    except Exception as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}")
+    return cacheable_response(*_entry(data_type)["file"])
 
-@cache.memoize()
+@json_response
 def history_country(data_type, country):
-    try:
-        data = util.read_json(f"csv_{data_type}.json")
-        for region in list(data.keys()):
-            if util.pattern_match(
-                country,
-                region,
-                data[region]["iso2"],
-                data[region]["iso3"]):
-                return jsonify(data[region])
+    body = _entry(data_type)["countries"].get(country.lower())
+    if body is None:
         raise CountryNotFound("This region cannot be found. Please try again.")
-    except CountryNotFound as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}", status=404)
-    except Exception as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}")
+    return body
 
-@cache.memoize()
+def _region_entry(data_type, country):
+    """Return the loaded region file holding `country`"""
+    if country.lower() in _US_ALIASES:
+        return _entry(data_type, "_us_region")
+    return _entry(data_type, "_region")
+
+@json_response
 def history_region(data_type, country, region_name):
-    try:
-        if country.lower() in ("us", "united states", "usa"):
-            data = util.read_json(f"csv_{data_type}_us_region.json")
-        else:
-            data = util.read_json(f"csv_{data_type}_region.json")
-        for inner_country in list(data.keys()):
-            if util.pattern_match(
-                country,
-                inner_country,
-                data[inner_country]["iso2"],
-                data[inner_country]["iso3"]):
-                for region in data[inner_country]["regions"]:
-                    if region.lower() == region_name.lower():
-                        return jsonify(data[inner_country]["regions"][region])
+    regions = _region_entry(data_type, country)["regions_by_name"].get(country.lower(), {})
+    body = regions.get(region_name.lower())
+    if body is None:
         raise RegionNotFound("This region cannot be found. Please try again.")
-    except RegionNotFound as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}", status=404)
-    except Exception as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}")
+    return body
 
-@cache.memoize()
+@json_response
 def history_region_all(data_type, country):
-    try:
-        if country.lower() in ("us", "united states", "usa"):
-            data = util.read_json(f"csv_{data_type}_us_region.json")
-        else:
-            data = util.read_json(f"csv_{data_type}_region.json")
-        for inner_country in list(data.keys()):
-            if util.pattern_match(
-                country,
-                inner_country,
-                data[inner_country]["iso2"],
-                data[inner_country]["iso3"]):
-                return jsonify(data[inner_country]["regions"])
+    body = _region_entry(data_type, country)["regions"].get(country.lower())
+    if body is None:
         raise CountryNotFound("This country cannot be found. Please try again.")
-    except CountryNotFound as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}", status=404)
-    except Exception as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}")
+    return body
 
-@cache.memoize()
 def history_region_world(data_type):
-    try:
-
-        data = util.read_json(f"csv_{data_type}.json")
-        ret = {"history" : {}}
-        for d in data.keys():
-            for h in data[d]["history"].keys():
-                if h not in ret["history"]:
-                    ret["history"][h] = int(data[d]["history"][h])
-                else:
-                    ret["history"][h] += int(data[d]["history"][h])
-        return jsonify(ret)
-    except Exception as e:
-        return util.response_error(message=f"{type(e).__name__} : {e}")
-
+    return cacheable_response(*_entry(data_type)["world"])
 
 
 @api.route(f"/api/{API_VERSION}/all/")
@@ -251,16 +386,3 @@ def index_api():
 def index_api_version():
     return jsonify(route_homepage)
 
-
-# if __name__ == '__main__':
-#     try:
-#         app.run(debug=True, host="0.0.0.0", port=5000)
-#     except KeyboardInterrupt:
-#         with app.app_context():
-#             cache.clear()
-#         exit(0)
-#     except Exception as e:
-#         print(type(e).__name__, e)
-#         with app.app_context():
-#             cache.clear()
-#         exit(1)
@@ -1 +1 @@
-gunicorn --worker-class gevent --workers 8 --bind 0.0.0.0:5000 app:app --log-level debug
\ No newline at end of file
+gunicorn --worker-class gevent --workers 2 --worker-connections 1000 --bind 0.0.0.0:5000 app:app --log-level debug
\ No newline at end of file
@@ -3,4 +3,8 @@ class RegionNotFound(Exception):
 
 
 class CountryNotFound(Exception):
+    pass
+
+
+class DataTypeNotFound(Exception):
     pass
\ No newline at end of file
@@ -1,14 +1,16 @@
 import csv
 import datetime
 import json
+import os
 import sqlite3
 import time
 import unicodedata
 from functools import wraps
 
+import orjson
 import requests
 from decouple import config
-from flask import jsonify, request, Response
+from flask import jsonify, request
 from flask_limiter.util import get_remote_address
 
 AUTHORIZATION = config("Authorization")
@@ -116,8 +118,7 @@ def csv_to_json(csv_fpath):
                 csv_json[k]["iso2"] = ""
                 csv_json[k]["iso3"] = ""
 
-        with open(csv_fpath.replace(".csv", ".json"), "w+") as f:
-            f.write(str(json.dumps(csv_json)))
+        write_json(csv_fpath.replace(".csv", ".json"), json.dumps(csv_json))
 
 def region_csv_to_json(csv_fpath, is_us=False):
     csv_json = {}
@@ -177,8 +178,7 @@ def region_csv_to_json(csv_fpath, is_us=False):
                 csv_json[k]["iso2"] = ""
                 csv_json[k]["iso3"] = ""
 
-        with open(csv_fpath.replace(".csv", "_region.json"), "w+") as f:
-            f.write(str(json.dumps(csv_json)))
+        write_json(csv_fpath.replace(".csv", "_region.json"), json.dumps(csv_json))
 
 def find_val_replace_null(country, data, base):
     try:
@@ -240,18 +240,20 @@ def store_data():
         merged_data.append(apify)
 
     merged_data = replace_null_value(merged_data)
-    with open("data.json", "w+") as fd:
-        dumps = json.dumps(merged_data)
-        fd.write(str(dumps))
+    write_json("data.json", json.dumps(merged_data))
+
+def write_json(fpath: str, dumps: str):
+    """Replace `fpath` atomically"""
+    tmp_fpath = f"{fpath}.tmp"
+    with open(tmp_fpath, "w+") as f:
+        f.write(dumps)
+    os.replace(tmp_fpath, fpath)
 
 def read_json(fpath: str):
-    with open(fpath, "r") as f:
-        data = json.load(f)
+    with open(fpath, "rb") as f:
+        data = orjson.loads(f.read())
     return data
 
-def pattern_match(to_match, *patterns):
-    return to_match.lower() in map(lambda x: x.lower(), patterns)
-
 def insert_user(ip, user_agent):
     with sqlite3.connect("user_list.db") as conn:
         c = conn.cursor()
@@ -277,8 +279,5 @@ def require_appkey(view_function):
 def no_limit_owner():
     return request.headers.get("Authorization") and request.headers.get("Authorization") == config("Authorization")
 
-def response_error(status=500, message="Internal server error"):
-    return Response(response=message, status=status)
-
 if __name__ == "__main__":
     update() # crontab